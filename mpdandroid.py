@@ -0,0 +1,255 @@
+import hashlib, json, os, re, threading, time
+from multiprocessing.pool import ThreadPool
+
+def to_unicode(s):
+    """ Decode s the way MpdDB decodes MPD file names. """
+    if isinstance(s, unicode):
+        return s
+    try:
+        return s.decode('utf-8')
+    except UnicodeDecodeError:
+        return s
+
+def to_bytes(s):
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return s
+
+def dest_name(filename, extension = None, unique = False):
+    """ Flat, FAT-safe name for filename on the device: '<dir> - <file>',
+        optionally with its extension replaced. With unique, a short hash
+        of filename is added, for files whose dir and file names are the
+        same as another's. """
+    base, ext = os.path.splitext(os.path.basename(filename))
+    if extension:
+        ext = extension
+    if unique:
+        base += " [%s]" % (hashlib.sha1(to_bytes(filename)).hexdigest()[:8],)
+    return re.sub(r'[\\/:\*\?\"\<\>\|]', '_',
+                  "%s - %s%s" % (os.path.basename(os.path.dirname(filename)),
+                                 base, ext))
+
+def write_atomically(path, data):
+    tmp = path + '.part'
+    fh = open(tmp, 'w')
+    fh.write(data)
+    fh.close()
+    os.rename(tmp, path)
+
+def copy_file(src, dst, bufsize):
+    """ Copy src to dst through a temporary file, keeping src's mtime.
+        Returns the md5 of the data copied. """
+    tmp = dst + '.part'
+    digest = hashlib.md5()
+    fsrc = open(src, 'rb')
+    fdst = open(tmp, 'wb')
+    try:
+        while True:
+            buf = fsrc.read(bufsize)
+            if not buf:
+                break
+            digest.update(buf)
+            fdst.write(buf)
+    finally:
+        fsrc.close()
+        fdst.close()
+    st = os.stat(src)
+    os.utime(tmp, (st.st_atime, st.st_mtime))
+    os.rename(tmp, dst)
+    return digest.hexdigest()
+
+class Device(object):
+    """ A directory on a mounted device (or any local directory) holding the
+        synced files, one '000-<playlist>.m3u' per playlist, and a manifest
+        recording what was copied from where, so that later syncs only copy
+        new or changed files without restating the whole device. Files
+        shared between playlists are stored once.
+
+        Names and paths are kept as unicode, like in the JSON manifest, and
+        only encoded back to utf-8 to touch the filesystem. """
+
+    MANIFEST = '.mpdsync.json'
+    BUFSIZE = 1024 * 1024
+
+    def __init__(self, root, jobs = 4):
+        self.root = root
+        self.jobs = jobs
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        self.manifest = self.load_manifest()
+        self.lock = threading.Lock()
+        self.copied = 0
+        self.bytes = 0
+
+    def load_manifest(self):
+        try:
+            manifest = json.load(open(os.path.join(self.root, self.MANIFEST)))
+        except (IOError, ValueError):
+            manifest = {}
+        manifest.setdefault('files', {})
+        manifest.setdefault('playlists', {})
+        return manifest
+
+    def save_manifest(self):
+        write_atomically(os.path.join(self.root, self.MANIFEST),
+                         json.dumps(self.manifest, indent = 1))
+
+    def path(self, name):
+        return os.path.join(self.root, to_bytes(name))
+
+    def m3u_path(self, playlist):
+        return self.path("000-%s.m3u" % (playlist,))
+
+    def origin(self, name):
+        entry = self.manifest['files'][name]
+        return entry.get('origin', entry['source'])
+
+    def is_current(self, name, source, st):
+        entry = self.manifest['files'].get(name)
+        return (entry is not None and
+                entry['source'] == source and
+                entry['size'] == st.st_size and
+                int(entry['mtime']) == int(st.st_mtime) and
+                os.path.isfile(self.path(name)))
+
+    def adopt(self, name, filename, source, st):
+        """ Record a file already on the device but not in the manifest (left
+            by an earlier rsync-based sync) if it looks like source. """
+        if name in self.manifest['files']:
+            return False
+        try:
+            dst = os.stat(self.path(name))
+        except OSError:
+            return False
+        if dst.st_size != st.st_size or int(dst.st_mtime) != int(st.st_mtime):
+            return False
+        self.manifest['files'][name] = { 'origin' : filename,
+                                         'source' : source,
+                                         'size' : st.st_size,
+                                         'mtime' : int(st.st_mtime) }
+        return True
+
+    def migrate(self, playlist, wanted):
+        """ Older versions synced each playlist to its own directory: move the
+            files still wanted from there to the device root, so they need
+            not be copied again, and remove the rest. """
+        legacy = self.path(playlist)
+        m3u = os.path.join(legacy, to_bytes("000-%s.m3u" % (playlist,)))
+        if not os.path.isfile(m3u):
+            return
+        print "Migrating %s" % (legacy,)
+        for line in open(m3u):
+            name = to_unicode(line.rstrip('\n'))
+            old = os.path.join(legacy, to_bytes(name))
+            if not name or not os.path.isfile(old):
+                continue
+            if name in wanted and not os.path.exists(self.path(name)):
+                os.rename(old, self.path(name))
+            else:
+                os.remove(old)
+        os.remove(m3u)
+        try:
+            os.rmdir(legacy)
+        except OSError:
+            print "** Leaving %s, it is not empty" % (legacy,)
+
+    def copy(self, job):
+        name, filename, source, st = job
+        try:
+            md5 = copy_file(to_bytes(source), self.path(name), self.BUFSIZE)
+        except (IOError, OSError), e:
+            print "** Problem copying %s: %s" % (to_bytes(source), e)
+            return
+        self.lock.acquire()
+        try:
+            self.manifest['files'][name] = { 'origin' : filename,
+                                             'source' : source,
+                                             'size' : st.st_size,
+                                             'mtime' : int(st.st_mtime),
+                                             'md5' : md5 }
+            self.copied += 1
+            self.bytes += st.st_size
+            print "  [%i] %s" % (self.copied, to_bytes(name))
+        finally:
+            self.lock.release()
+
+    def sync(self, playlists, transcoded = {}):
+        """ Sync playlists, a dict of playlist name -> list of filenames.
+            transcoded maps filenames to the file to copy in their place.
+            Playlists synced earlier but not passed here are left alone. """
+        synced = [ to_unicode(playlist) for playlist in playlists ]
+
+        # device name -> original file it holds, to detect collisions
+        owners = {}
+        for playlist, names in self.manifest['playlists'].iteritems():
+            if not playlist in synced:
+                for name in names:
+                    owners[name] = self.origin(name)
+
+        files = {} # device name -> (filename, source, stat)
+        for playlist, filenames in playlists.iteritems():
+            playlist = to_unicode(playlist)
+            names = []
+            for filename in filenames:
+                source = to_unicode(transcoded.get(filename, filename))
+                filename = to_unicode(filename)
+                extension = os.path.splitext(source)[1]
+                name = dest_name(filename, extension)
+                if owners.get(name, filename) != filename:
+                    name = dest_name(filename, extension, unique = True)
+                try:
+                    st = os.stat(to_bytes(source))
+                except OSError, e:
+                    print "** Skipping %s: %s" % (to_bytes(filename), e)
+                    continue
+                owners[name] = filename
+                files[name] = (filename, source, st)
+                names.append(name)
+            self.manifest['playlists'][playlist] = names
+
+        for playlist in synced:
+            self.migrate(playlist, files)
+
+        jobs = []
+        for name, (filename, source, st) in files.iteritems():
+            if not self.is_current(name, source, st) and \
+                   not self.adopt(name, filename, source, st):
+                jobs.append((name, filename, source, st))
+
+        print "%i files to copy" % (len(jobs),)
+        start = time.time()
+        pool = ThreadPool(self.jobs)
+        try:
+            pool.map(self.copy, jobs)
+        finally:
+            pool.close()
+            pool.join()
+        elapsed = max(time.time() - start, 0.001)
+        print "Copied %i files, %.1f MB in %.1fs (%.1f MB/s)" % \
+              (self.copied, self.bytes / 1048576., elapsed,
+               self.bytes / 1048576. / elapsed)
+
+        for playlist in synced:
+            present = [ name for name in self.manifest['playlists'][playlist]
+                        if name in self.manifest['files'] ]
+            write_atomically(self.m3u_path(playlist),
+                             ''.join([ to_bytes(name) + "\n"
+                                       for name in present ]))
+
+        self.delete_stale()
+        self.save_manifest()
+
+    def delete_stale(self):
+        """ Remove the files no playlist in the manifest references. """
+        wanted = set()
+        for names in self.manifest['playlists'].values():
+            wanted.update(names)
+        for name in self.manifest['files'].keys():
+            if name in wanted:
+                continue
+            print "  removing %s" % (to_bytes(name),)
+            try:
+                os.remove(self.path(name))
+            except OSError:
+                pass
+            del self.manifest['files'][name]
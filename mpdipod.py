@@ -1,20 +1,157 @@
-import gpod, os
+import difflib, gpod, multiprocessing, os
+import mpdutils
 
-def compare_tracks(a, b):
-    return ( #a['size'] == b['size'] and
-            a['title'] == b['title'] and
-            a['artist'] == b['artist'] and
-            a['album'] == b['album'])
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Covers dir, holding <artist>/<album>.jpg
+COVERS_DIR = os.path.expanduser('~/.covers/')
+
+# where scaled covers are kept
+DEFAULT_ARTWORK_CACHE = os.path.join(os.path.dirname(mpdutils.DEFAULT_TRANSCODE_CACHE),
+                                     "covers")
+
+def track_key(track):
+    return (track['title'], track['artist'], track['album'])
+
+def diff_playlist(old, new):
+    """ Compute a minimal edit plan turning the sequence of tracks old into
+        new. Tracks are compared with track_key(), and the result is a list
+        of ('delete', track), ('move', pos, track) and ('insert', pos, track)
+        steps; positions are relative to the final playlist. A track
+        deleted at one place and inserted at another becomes a single move
+        of the existing track. """
+    matcher = difflib.SequenceMatcher(None,
+                                      [ track_key(t) for t in old ],
+                                      [ track_key(t) for t in new ],
+                                      autojunk = False)
+    deleted = {}
+    inserted = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag in ('delete', 'replace'):
+            for track in old[i1:i2]:
+                deleted.setdefault(track_key(track), []).append(track)
+        if tag in ('insert', 'replace'):
+            for j in range(j1, j2):
+                inserted.append((j, new[j]))
+
+    moves = []
+    inserts = []
+    for pos, track in inserted:
+        candidates = deleted.get(track_key(track))
+        if candidates:
+            moves.append(('move', pos, candidates.pop(0)))
+        else:
+            inserts.append(('insert', pos, track))
+    deletes = [ ('delete', track)
+                for tracks in deleted.values() for track in tracks ]
+
+    return deletes + sorted(moves + inserts, key = lambda step: step[1])
 
 class FreeSpaceException(Exception): pass
 
+def _scale_cover(job):
+    """ Pool worker: write src scaled down to fit in size x size to dst.
+        Returns the file to use as cover. """
+    src, dst, size = job
+    try:
+        image = Image.open(src)
+        image.thumbnail((size, size), Image.ANTIALIAS)
+        tmp = dst + '.part'
+        image.convert('RGB').save(tmp, 'JPEG', quality = 90)
+        os.rename(tmp, dst)
+        return dst
+    except (IOError, OSError), e:
+        print "** Problem scaling %s: %s" % (src, e)
+        return src
+
+class Artwork(object):
+    """ Cover art, resolved once per album and scaled down ahead of
+        time in a process pool, so that libgpod gets a small image for each
+        album instead of decoding the full-size one for every track. Scaled
+        covers are cached on disk by source image hash and size. """
+
+    # largest cover art format of the iPods we sync to
+    SIZE = 320
+    FILENAMES = ('cover.jpg', 'folder.jpg', 'front.jpg')
+
+    def __init__(self, covers_dir = COVERS_DIR,
+                 cache_dir = DEFAULT_ARTWORK_CACHE, size = SIZE):
+        self.covers_dir = covers_dir
+        self.cache_dir = cache_dir
+        self.size = size
+        self.covers = {} # album key() -> cover file, or None
+
+    def find_cover(self, artist, album, filename):
+        candidates = []
+        if artist and album:
+            candidates.append(os.path.join(self.covers_dir, artist,
+                                           "%s.jpg" % (album,)))
+        candidates += [ os.path.join(os.path.dirname(filename), name)
+                        for name in self.FILENAMES ]
+        for cover in candidates:
+            if os.path.isfile(cover):
+                return cover
+        return None
+
+    @staticmethod
+    def key(artist, album, filename):
+        """ Albums are told apart by their directory too: untagged tracks,
+            or two albums with the same artist and name, don't share a
+            cover. """
+        return (artist, album, os.path.dirname(filename))
+
+    def prepare(self, tracks):
+        """ Resolve and scale the covers for tracks, a list of (artist,
+            album, filename). """
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        jobs = {}
+        for artist, album, filename in tracks:
+            key = self.key(artist, album, filename)
+            if key in self.covers:
+                continue
+            cover = self.find_cover(artist, album, filename)
+            self.covers[key] = cover
+            if cover is None or Image is None: # no PIL: use covers as is
+                continue
+            scaled = os.path.join(self.cache_dir, "%s-%i.jpg" %
+                                  (mpdutils.hash_file(cover), self.size))
+            self.covers[key] = scaled
+            if not os.path.isfile(scaled) and not scaled in jobs:
+                jobs[scaled] = (cover, scaled, self.size)
+
+        if not jobs:
+            return
+        pool = multiprocessing.Pool()
+        try:
+            results = pool.map(_scale_cover, jobs.values())
+        finally:
+            pool.close()
+            pool.join()
+        # covers that could not be scaled are used as they are
+        results = dict(zip(jobs.keys(), results))
+        for key, cover in self.covers.items():
+            if cover in results:
+                self.covers[key] = results[cover]
+
+    def get(self, artist, album, filename):
+        key = self.key(artist, album, filename)
+        if not key in self.covers:
+            self.prepare([ (artist, album, filename) ])
+        return self.covers[key]
+
 class iPod(object):
 
     SIZE_FUDGE = 0.4 # safety factor, in gigabytes
 
-    def __init__(self, path):
+    def __init__(self, path, covers_dir = COVERS_DIR):
         self.path = path
         self.db = gpod.Database(self.path)
+        self.artwork = Artwork(covers_dir)
 
     # simplistic, but OK
     def used_space(self):
@@ -35,74 +172,220 @@ class iPod(object):
         print "Capacity: %i" % int((info.capacity - iPod.SIZE_FUDGE) * 1024 * 1024 * 1024)
         return int((info.capacity - iPod.SIZE_FUDGE) * 1024 * 1024 * 1024)
 
-    def free_space(self):
-          return self.ipod_capacity() - self.used_space()
-
-    def sync_playlist(self, name, tracks):
+    def find_playlist(self, name):
         for playlist in self.db.Playlists:
-            print "found: %s" % playlist.name
             if playlist.name == name:
-                for i, track in enumerate(tracks):
-                    if i >= len(playlist):
-                        playlist.add(track)
-                        continue
-                    if not compare_tracks(track, playlist[i]):
-                        to_del = playlist[i]
-                        playlist.remove(to_del)
-                        try:
-                            self.db.Master.remove(to_del)
-                        except:
-                            print "** Problem removing %s" % (track,)
-                        playlist.add(track, pos = i)
-                if len(playlist) - 1 > i:
-                    for track in playlist[i + 1:]:
-                        playlist.remove(track)
-                        self.db.Master.remove(track)
-                return True
-        playlist = self.db.new_Playlist(title = name)
-        for track in tracks:
-            print "about to add: %s" % track
-            playlist.add(track)
-        return True
+                return playlist
+        return None
+
+    def sync_playlist(self, name, tracks, dry_run = False):
+        """ Bring the playlist called name in line with tracks, using the
+            smallest set of deletes, moves and inserts. Tracks are only taken
+            out of the playlist, not off the iPod. Returns the edit plan;
+            with dry_run, only print it. """
+        playlist = self.find_playlist(name)
+        if playlist is None:
+            plan = [ ('insert', i, track) for i, track in enumerate(tracks) ]
+        else:
+            plan = diff_playlist(list(playlist), tracks)
+
+        for step in plan:
+            print "%s: %s - %s - %s" % ((step[0],) + track_key(step[-1]))
+        if dry_run:
+            return plan
 
-    def check_freespace(self, tracks):
-        size = sum([ track['size'] for track in tracks ])
-        return size < self.free_space()
+        if playlist is None:
+            playlist = self.db.new_Playlist(title = name)
+
+        # take out everything that goes away or moves first, so that inserts
+        # in ascending order land at their final positions
+        for step in plan:
+            if step[0] in ('delete', 'move'):
+                playlist.remove(step[-1])
+
+        for step in plan:
+            if step[0] in ('move', 'insert'):
+                playlist.add(step[2], pos = step[1])
+        return plan
 
     def close(self):
         self.db.copy_delayed_files()
         self.db.close()
 
-    def track_factory(self, filename):
-        print filename
+    def probe_track(self, filename):
+        """ Read the tags of filename, without adding it to the database. """
         try:
-            _track = gpod.Track(filename)
+            return gpod.Track(filename)
         except:
             print "FAIL !!!"
             return None
 
-        debug = False
-        if filename.find('Mama') > 0:
-            debug = True
-            print _track
-
-        for track in self.db.Master:
-            if debug and track['title'].find('Mama') > 0:
-                print track
-                print track['size']
-                print _track['size']
-            if compare_tracks(_track, track):
-                print "Same file: %s" % filename
-                return track
+    def add_track(self, filename, original = None):
+        """ Copy filename to the iPod; original is the file it was
+            transcoded from, if any, next to which its cover is looked
+            for. """
         print "New file: %s" % filename
         t = self.db.new_Track(filename = filename)
         try:
-            cover = os.path.join(COVERS_DIR, t['artist'],
-                             "%s.jpg" % (t['album'], ))
-            if os.path.isfile(cover):
+            cover = self.artwork.get(t['artist'], t['album'],
+                                     original or filename)
+            if cover:
                 print "Setting cover for %s" % (filename,)
                 t.set_coverart_from_file(cover)
         except:
             pass
 
         return t
+
+class SyncPlanner(object):
+    """ Plan the sync of several playlists as a whole: the device is probed
+        and Master walked only once, tracks shared between playlists are
+        counted and copied once, and tracks already on the iPod are not
+        counted as new usage. self.used starts from a single walk of Master
+        and is then kept up to date as tracks are added and removed.
+
+        priority, if given, is called with the original file name of each
+        new track; when they don't all fit, the tracks with the highest
+        values are copied first.
+
+        With a transcoder, only the new tracks that are actually copied get
+        transcoded, right before being added. """
+
+    def __init__(self, ipod, priority = None, transcoder = None):
+        self.ipod = ipod
+        self.priority = priority
+        self.transcoder = transcoder
+        self.capacity = ipod.ipod_capacity()
+        self.used = ipod.used_space()
+        self.on_device = {}
+        for track in ipod.db.Master:
+            self.on_device[track_key(track)] = track
+        self.new = {} # key -> (filename, probed track) for tracks to copy
+        self.sizes = {} # key -> expected size on the iPod of self.new's
+        self.order = [] # keys of self.new, in the order they were seen
+        self.playlists = [] # (name, [key, ...])
+
+    def add_playlist(self, name, filenames):
+        """ Add a playlist to the plan. Tags are read from the original
+            files; with a transcoder, a file's expected size is that of its
+            cached encode if there is one, else the original's as an upper
+            bound. """
+        cached = {}
+        if self.transcoder:
+            cached = self.transcoder.cached(filenames)
+        keys = []
+        for filename in filenames:
+            track = self.ipod.probe_track(filename)
+            if track is None and filename in cached:
+                track = self.ipod.probe_track(cached[filename])
+            if track is None:
+                continue
+            key = track_key(track)
+            if key not in self.on_device and key not in self.new:
+                self.new[key] = (filename, track)
+                if filename in cached:
+                    self.sizes[key] = os.path.getsize(cached[filename])
+                else:
+                    self.sizes[key] = track['size']
+                self.order.append(key)
+            keys.append(key)
+        self.playlists.append((name, keys))
+
+    def added_space(self, keys = None):
+        if keys is None:
+            keys = self.new.keys()
+        return sum([ self.sizes[key] for key in keys ])
+
+    def dropped(self):
+        """ The tracks that will leave the iPod, as a dict key -> track:
+            those dropped from the synced playlists and not used by any other
+            playlist. """
+        names = [ name for name, keys in self.playlists ]
+        kept = set()
+        for name, keys in self.playlists:
+            kept.update(keys)
+        for playlist in self.ipod.db.Playlists:
+            if not playlist.master and not playlist.name in names:
+                kept.update([ track_key(track) for track in playlist ])
+
+        freed = {}
+        for name in names:
+            playlist = self.ipod.find_playlist(name)
+            if playlist is None:
+                continue
+            for track in playlist:
+                key = track_key(track)
+                if not key in kept:
+                    freed[key] = track
+        return freed
+
+    def select(self, freed, fill = False):
+        """ Return the keys of the new tracks to copy, given the freed bytes
+            of the dropped tracks. If they don't all fit and fill is set,
+            pick them by decreasing priority (then playlist order) until the
+            iPod is full; otherwise raise FreeSpaceException. """
+        free = self.capacity - self.used + freed
+        if self.added_space() < free:
+            return set(self.new.keys())
+        if not fill:
+            raise FreeSpaceException("Not enough free space: need %i more bytes"
+                                     % (self.added_space() - free,))
+
+        order = self.order
+        if self.priority:
+            order = sorted(order, reverse = True,
+                           key = lambda k: self.priority(self.new[k][0]))
+        chosen = set()
+        for key in order:
+            size = self.sizes[key]
+            if size < free:
+                chosen.add(key)
+                free -= size
+        print "Only %i of %i new tracks fit" % (len(chosen), len(self.new))
+        return chosen
+
+    def execute(self, fill = False, dry_run = False):
+        dropped = self.dropped()
+        chosen = self.select(sum([ t['size'] for t in dropped.values() ]),
+                             fill)
+        used = self.used
+        transcoded = {}
+        if not dry_run:
+            if self.transcoder:
+                transcoded = self.transcoder.transcode([ self.new[key][0]
+                                                         for key in chosen ])
+            self.ipod.artwork.prepare([ (self.new[key][1]['artist'],
+                                         self.new[key][1]['album'],
+                                         self.new[key][0])
+                                        for key in self.order
+                                        if key in chosen ])
+
+        tracks = dict(self.on_device)
+        for key in self.order:
+            if not key in chosen:
+                continue
+            filename, track = self.new[key]
+            if dry_run:
+                self.used += self.sizes[key]
+            else:
+                track = self.ipod.add_track(transcoded.get(filename, filename),
+                                            filename)
+                self.used += track['size']
+            tracks[key] = track
+
+        for name, keys in self.playlists:
+            self.ipod.sync_playlist(name,
+                                    [ tracks[key] for key in keys
+                                      if key in tracks ],
+                                    dry_run)
+
+        # only now that every playlist is synced: a track one playlist drops
+        # may be picked up by another
+        for track in dropped.values():
+            print "remove: %s - %s - %s" % track_key(track)
+            if not dry_run:
+                self.ipod.db.remove(track, ipod = True)
+            self.used -= track['size']
+
+        print "Delta: %i, used: %i" % (self.used - used, self.used)
+        return True
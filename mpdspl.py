@@ -10,7 +10,7 @@
 # This code is licensed under the GPL v3, or any later version at your choice.
 
 import codecs, cPickle, datetime, operator, optparse
-import os, os.path, sqlite3, sys, re, textwrap, time
+import os, os.path, select, signal, sqlite3, sys, re, textwrap, time
 
 import mpd
 
@@ -46,7 +46,8 @@ KEYWORDS = {"ar"   : ("Artist", "Artist"),
             "raar" : ("RatingAr", "Artist rating"),
             "raal" : ("RatingAl", "Album rating"),
             "rag"  : ("RatingGe", "Genre rating"),
-            "pc"   : ("PlayCount", "Play Count") }
+            "pc"   : ("PlayCount", "Play Count"),
+            "lp"   : ("LastPlayed", "Last played time") }
 
 class CustomException(Exception):
     pass
@@ -74,6 +75,10 @@ class AbstractRule:
 
     def getOperator(self):
         return self.OPERATORS[self.operator]
+
+    def reset(self):
+        """ Called before each matching pass over the tracks. """
+        pass
     
     def match(self, track):
         attr = getattr(track, self.key.lower())
@@ -155,6 +160,9 @@ class TimeDeltaRule(AbstractRule):
             self.unit += 's'
 
         self.value = datetime.timedelta(**{self.unit : self.number})
+        self.reset()
+
+    def reset(self):
         self.now = datetime.datetime.now()
 
     def __match__(self, value):
@@ -256,6 +264,8 @@ class Playlist:
 
     def findMatchingTracks(self, mpdDB):
         self.tracks = []
+        for rule in self.rules:
+            rule.reset()
     
         for track in mpdDB.getTracks():
             toAdd = True
@@ -279,7 +289,7 @@ class Playlist:
 
     def writeM3u(self):
         filePath = self.getM3uPath()
-        print "Saving playlist '%s' to '%s'" % (playlist.name, filePath)
+        print "Saving playlist '%s' to '%s'" % (self.name, filePath)
         open(filePath, 'w').write(self.m3u + '\n')
 
 class PlaylistSet:
@@ -374,13 +384,13 @@ class MpdDB:
 
         curs = conn.cursor()
 
-        curs.execute('SELECT * FROM sticker WHERE type=? and name=?',
-                     ("song", "rating"))
+        curs.execute('SELECT * FROM sticker WHERE type=? and name IN (?, ?, ?)',
+                     ("song", "rating") + PlayTracker.STICKERS)
 
         for row in curs:
             filePath = row[1]
             if filePath in self.tracks:
-                self.tracks[filePath].rating = row[3]
+                setattr(self.tracks[filePath], row[2], row[3])
 
     def __parseMpdcronDB(self):
         conn = sqlite3.connect(self.mpdcronStatsFile)
@@ -407,6 +417,133 @@ AND song.rating + artist.rating + album.rating + genre.rating + song.play_count
     def getTracks(self):
         return self.tracks.values()
 
+class PlayTracker:
+    """ Collect play counts and last played times by following MPD's player
+        events, without needing mpdcron. Stats are kept in memory, where
+        they can be applied to an MpdDB for rules to use, and written back
+        to the sticker DB in one transaction every flushInterval seconds. """
+
+    STICKERS = ("playcount", "lastplayed")
+    MAX_PLAYED = 240 # a song played this long counts, even if not half done
+
+    def __init__(self, host, port, password, stickerFile, flushInterval):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.stickerFile = stickerFile
+        self.flushInterval = flushInterval
+        self.stats = {} # uri -> [play count, last played]
+        self.pending = {} # uri -> [plays since last flush, last played]
+        self.__loadStickerDB()
+
+    def __loadStickerDB(self):
+        conn = sqlite3.connect(self.stickerFile)
+        curs = conn.cursor()
+        curs.execute('SELECT uri, name, value FROM sticker WHERE type=? and name IN (?, ?)',
+                     ("song",) + self.STICKERS)
+        for uri, name, value in curs:
+            stats = self.stats.setdefault(uri, [0, 0])
+            stats[self.STICKERS.index(name)] = int(float(value))
+        conn.close()
+
+    def record(self, uri, when):
+        for d in (self.stats, self.pending):
+            stats = d.setdefault(uri, [0, 0])
+            stats[0] += 1
+            stats[1] = int(when)
+
+    def flush(self):
+        if not self.pending:
+            return
+        conn = sqlite3.connect(self.stickerFile)
+        try:
+            conn.executemany('INSERT OR REPLACE INTO sticker VALUES (?, ?, ?, ?)',
+                             [ row for uri, (playCount, lastPlayed)
+                               in self.stats.iteritems() if uri in self.pending
+                               for row in (("song", uri, "playcount", str(playCount)),
+                                           ("song", uri, "lastplayed", str(lastPlayed))) ])
+            conn.commit()
+        finally:
+            conn.close()
+        self.pending = {}
+
+    def apply(self, mpdDB):
+        for uri, (playCount, lastPlayed) in self.stats.iteritems():
+            if uri in mpdDB.tracks:
+                mpdDB.tracks[uri].playcount = playCount
+                mpdDB.tracks[uri].lastplayed = lastPlayed
+
+    def __isPlay(self, uri, duration, played):
+        # without a known duration (streams...), we can't tell
+        return uri and duration and \
+               played >= min(duration / 2., self.MAX_PLAYED)
+
+    def __waitForPlayer(self, client, timeout):
+        """ Wait at most timeout seconds for a player event. """
+        client.send_idle('player')
+        try:
+            fd = client.fileno()
+        except AttributeError: # older python-mpd
+            fd = client._sock
+        if select.select([fd], [], [], timeout)[0]:
+            client.fetch_idle()
+        else:
+            client.noidle()
+
+    def run(self, onFlush = None):
+        """ Follow player events until killed; onFlush is called after each
+            write-back. """
+        client = mpd.MPDClient()
+        client.connect(self.host, self.port)
+        if self.password:
+            client.password(self.password)
+
+        # turn SIGTERM into SystemExit, so pending stats still get written
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+        songId = uri = None
+        duration = played = 0
+        since = lastFlush = time.time()
+        playing = False
+        try:
+            while True:
+                now = time.time()
+                if playing:
+                    played += now - since
+                status = client.status()
+                state = status['state']
+                if state == 'stop' or status.get('songid') != songId:
+                    if self.__isPlay(uri, duration, played):
+                        self.record(uri, now)
+                    songId = status.get('songid')
+                    song = client.currentsong()
+                    uri = song.get('file')
+                    if uri:
+                        try:
+                            uri = uri.decode('utf-8')
+                        except:
+                            pass
+                    duration = float(song.get('duration',
+                                              song.get('time', 0)))
+                    played = 0
+                since = now
+                playing = state == 'play'
+
+                if now - lastFlush >= self.flushInterval and self.pending:
+                    self.flush()
+                    lastFlush = now
+                    if onFlush:
+                        onFlush(self)
+
+                self.__waitForPlayer(client, self.flushInterval)
+        finally:
+            # the song being played when we stop counts too
+            if playing:
+                played += time.time() - since
+            if self.__isPlay(uri, duration, played):
+                self.record(uri, time.time())
+            self.flush()
+
 class IndentedHelpFormatterWithNL(optparse.IndentedHelpFormatter):
     """ So optparse doesn't mangle our help description. """
     def format_description(self, description):
@@ -496,6 +633,15 @@ def parseArgs(args):
                       action="store", default='',
                       help="Only print the final track list to STDOUT")
 
+    parser.add_option("-t", "--track-plays", dest="trackPlays",
+                      action="store_true", default=False,
+                      help="Keep running, record play counts and last played times in the sticker file (-s), and update playlists as they change")
+
+    parser.add_option("-i", "--flush-interval", dest="flushInterval",
+                      type="int", default=300,
+                      help="How often to write play stats to the sticker file, in seconds",
+                      metavar="SECONDS")
+
     parser.add_option("-w", "--password", dest="password",
                       default=None, help="Password to connect to MPD",
                       metavar="PASSWORD")
@@ -506,6 +652,10 @@ def parseArgs(args):
         print "Can't use -s and -m at the same time, as they both provide ratings."
         sys.exit(2)
 
+    if options.trackPlays and not options.stickerFile:
+        print "-t needs a sticker file (-s) to write play stats to."
+        sys.exit(2)
+
     # we'll use dataDir=None to indicate we want simpleOutput
     if options.simpleOutput:
         options.dataDir = None
@@ -522,7 +672,8 @@ def parseArgs(args):
     return options.forceUpdate, options.cacheFile, options.dataDir, \
            options.host, options.port, options.stickerFile, \
            options.mpdcronStatsFile, \
-           options.playlistDirectory, options.playlists, options.password
+           options.playlistDirectory, options.playlists, options.password, \
+           options.trackPlays, options.flushInterval
 
 def savegubbage(data, path):
     if not os.path.isdir(os.path.dirname(path)):
@@ -532,12 +683,24 @@ def savegubbage(data, path):
 def loadgubbage(path):
     return cPickle.load(open(path, "rb"))
 
+def updatePlaylists(playlistSet, mpdDB, dataDir):
+    for playlist in playlistSet.getPlaylists():
+        playlist.findMatchingTracks(mpdDB)
+
+        if not dataDir: # stdout
+            if playlist.m3u:
+                print playlist.m3u
+        else: # write to .m3u & save
+            playlist.writeM3u()
+            playlist.save()
+
 if __name__ == '__main__':
    try:
       forceUpdate, cacheFile, dataDir, \
                    host, port, stickerFile, \
                    mpdcronStatsFile, \
-                   playlistDir, playlists, password = parseArgs(sys.argv[1:])
+                   playlistDir, playlists, password, \
+                   trackPlays, flushInterval = parseArgs(sys.argv[1:])
 
       MpdDB.initStaticAttributes(cacheFile)
       Playlist.initStaticAttributes(playlistDir, dataDir)
@@ -567,15 +730,22 @@ if __name__ == '__main__':
           for name in os.listdir(Playlist.CACHE_DIR):
               playlistSet.addMarshalled(name)
 
-      for playlist in playlistSet.getPlaylists():
-          playlist.findMatchingTracks(mpdDB)
-
-          if not dataDir: # stdout
-              if playlist.m3u:
-                  print playlist.m3u
-          else: # write to .m3u & save
-              playlist.writeM3u()
-              playlist.save()
+      if trackPlays:
+          tracker = PlayTracker(host, port, password, stickerFile, flushInterval)
+          tracker.apply(mpdDB)
+
+      updatePlaylists(playlistSet, mpdDB, dataDir)
+
+      if trackPlays:
+          # rules are matched against the in-memory stats as they change
+          def onFlush(tracker):
+              tracker.apply(mpdDB)
+              mpdDB.save()
+              updatePlaylists(playlistSet, mpdDB, dataDir)
+          try:
+              tracker.run(onFlush)
+          except KeyboardInterrupt:
+              pass
    except CustomException, e:
        print e.message
        sys.exit(2)
@@ -1,7 +1,244 @@
-import mpd, os
+import hashlib, json, multiprocessing, os, shlex, sqlite3, subprocess
+import tempfile, time
+import mpd
+
+# where transcoded files are kept, shared by all devices
+DEFAULT_TRANSCODE_CACHE = os.environ.get('XDG_CACHE_HOME',
+                                         os.path.join(os.environ['HOME'], ".cache"))
+DEFAULT_TRANSCODE_CACHE = os.path.expanduser(os.path.join(DEFAULT_TRANSCODE_CACHE,
+                                                          "mpdsync/transcode"))
+
+# %(input)s and %(output)s are replaced by the file names
+DEFAULT_ENCODER = "ffmpeg -loglevel error -y -i %(input)s -map_metadata 0 " \
+                  "-id3v2_version 3 -codec:a libmp3lame -q:a 2 %(output)s"
 
 def get_filenames(mpd_playlist, mpd_connection, mp3_root):
     client = mpd.MPDClient()
     client.connect(*mpd_connection)
     return [ os.path.join(mp3_root, filename)
              for filename in client.listplaylist(mpd_playlist) ]
+
+def get_ratings(sticker_file):
+    """ Song ratings from the MPD sticker file, as a dict of utf-8 encoded
+        file name (relative to the MPD root) -> rating. """
+    conn = sqlite3.connect(sticker_file)
+    ratings = {}
+    for uri, value in conn.execute('SELECT uri, value FROM sticker WHERE type=? and name=?',
+                                   ("song", "rating")):
+        try:
+            ratings[uri.encode('utf-8')] = float(value)
+        except ValueError:
+            pass
+    conn.close()
+    return ratings
+
+def hash_file(filename, bufsize = 1024 * 1024):
+    digest = hashlib.sha1()
+    fh = open(filename, 'rb')
+    try:
+        while True:
+            buf = fh.read(bufsize)
+            if not buf:
+                break
+            digest.update(buf)
+    finally:
+        fh.close()
+    return digest.hexdigest()
+
+def add_transcode_options(parser):
+    parser.add_option("-t", "--transcode", dest="transcode",
+                      action="store_true", default=False,
+                      help="Transcode lossless files before copying them")
+    parser.add_option("-e", "--encoder", dest="encoder",
+                      metavar="COMMAND", default=DEFAULT_ENCODER,
+                      help="Encoder command, with %(input)s and %(output)s placeholders")
+    parser.add_option("-x", "--extension", dest="extension",
+                      metavar="EXT", default=".mp3",
+                      help="Extension of the encoder's output files")
+    parser.add_option("-c", "--cache-size", dest="cacheSize", type="int",
+                      metavar="MB", default=10240,
+                      help="Maximum size of the transcode cache, in megabytes")
+
+def get_transcoder(options):
+    """ The Transcoder asked for by the add_transcode_options() options, or
+        None. """
+    if not options.transcode:
+        return None
+    return Transcoder(options.encoder, options.extension,
+                      max_size = options.cacheSize * 1024 * 1024)
+
+def transcode_output(cache_dir, content, encoder, extension):
+    key = hashlib.sha1(content + encoder + extension).hexdigest()
+    return os.path.join(cache_dir, key + extension)
+
+def _hash(filename):
+    """ Pool worker: returns (filename, content hash or None). """
+    try:
+        return filename, hash_file(filename)
+    except (IOError, OSError), e:
+        print "** Problem reading %s: %s" % (filename, e)
+        return filename, None
+
+def _transcode(job):
+    """ Pool worker: encode filename into output, unless it is already
+        there. Returns output, or None if encoding failed. """
+    filename, output, encoder, extension, cache_dir = job
+    if os.path.isfile(output):
+        return output
+    try:
+        # a temporary file of our own, so that a half-written output is
+        # never mistaken for a cached one
+        fd, tmp = tempfile.mkstemp(dir = cache_dir, suffix = extension)
+        os.close(fd)
+        try:
+            args = [ arg.replace('%(input)s', filename).replace('%(output)s', tmp)
+                     for arg in shlex.split(encoder) ]
+            if subprocess.call(args) != 0 or not os.path.getsize(tmp):
+                print "** Problem transcoding %s" % (filename,)
+                return None
+            os.rename(tmp, output)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        print "Transcoded %s" % (filename,)
+        return output
+    except (IOError, OSError), e:
+        print "** Problem transcoding %s: %s" % (filename, e)
+        return None
+
+class Transcoder(object):
+    """ Transcode files through an external encoder command, in a process
+        pool, into a cache keyed by source content and encoder settings, so
+        that syncing several devices reuses earlier encodes. The cache is
+        kept under max_size bytes by evicting the least recently used
+        files; recency is kept in the index rather than in the files' mtime,
+        which device syncs use to tell whether a file changed. """
+
+    EXTENSIONS = ('.flac', '.wav', '.ape', '.wv')
+    INDEX = 'index.json'
+
+    def __init__(self, encoder = DEFAULT_ENCODER, extension = '.mp3',
+                 cache_dir = DEFAULT_TRANSCODE_CACHE,
+                 max_size = 10 * 1024 * 1024 * 1024, processes = None):
+        self.encoder = encoder
+        self.extension = extension
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.processes = processes or multiprocessing.cpu_count()
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        # 'sources': filename -> [size, mtime, content hash], to avoid
+        # rehashing; 'used': cached file name -> last time it was used
+        try:
+            self.index = json.load(open(os.path.join(self.cache_dir,
+                                                     self.INDEX)))
+        except (IOError, ValueError):
+            self.index = {}
+        if not 'sources' in self.index:
+            self.index = { 'sources' : {}, 'used' : {} }
+
+    def needs_transcoding(self, filename):
+        return os.path.splitext(filename)[1].lower() in self.EXTENSIONS
+
+    def known_hash(self, filename):
+        entry = self.index['sources'].get(filename)
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        if entry and entry[0] == st.st_size and entry[1] == int(st.st_mtime):
+            return entry[2]
+        return None
+
+    def transcode(self, filenames):
+        """ Return a dict mapping each of filenames that needs transcoding
+            to its cached transcoded file. Sources are hashed first, so that
+            files with the same contents are only encoded once. """
+        filenames = [ filename for filename in set(filenames)
+                      if self.needs_transcoding(filename) ]
+        if not filenames:
+            return {}
+
+        pool = multiprocessing.Pool(self.processes)
+        try:
+            contents = {}
+            unknown = []
+            for filename in filenames:
+                content = self.known_hash(filename)
+                if content is None:
+                    unknown.append(filename)
+                else:
+                    contents[filename] = content
+            for filename, content in pool.map(_hash, unknown):
+                if content is None:
+                    continue
+                st = os.stat(filename)
+                self.index['sources'][filename] = [ st.st_size,
+                                                    int(st.st_mtime), content ]
+                contents[filename] = content
+
+            # output -> source to encode it from, one per content
+            jobs = {}
+            for filename, content in contents.iteritems():
+                output = transcode_output(self.cache_dir, content,
+                                          self.encoder, self.extension)
+                jobs.setdefault(output, filename)
+            results = pool.map(_transcode,
+                               [ (filename, output, self.encoder,
+                                  self.extension, self.cache_dir)
+                                 for output, filename in jobs.iteritems() ])
+        finally:
+            pool.close()
+            pool.join()
+
+        encoded = set([ output for output in results if output ])
+        transcoded = {}
+        now = time.time()
+        for filename, content in contents.iteritems():
+            output = transcode_output(self.cache_dir, content,
+                                      self.encoder, self.extension)
+            if output in encoded:
+                self.index['used'][os.path.basename(output)] = now
+                transcoded[filename] = output
+
+        self.evict(encoded)
+        tmp = os.path.join(self.cache_dir, self.INDEX + '.part')
+        json.dump(self.index, open(tmp, 'w'))
+        os.rename(tmp, os.path.join(self.cache_dir, self.INDEX))
+        return transcoded
+
+    def cached(self, filenames):
+        """ Like transcode(), but only for the files already in the cache:
+            nothing is hashed, encoded or evicted. """
+        transcoded = {}
+        for filename in set(filenames):
+            content = self.known_hash(filename)
+            if not self.needs_transcoding(filename) or content is None:
+                continue
+            output = transcode_output(self.cache_dir, content,
+                                      self.encoder, self.extension)
+            if os.path.isfile(output):
+                transcoded[filename] = output
+        return transcoded
+
+    def evict(self, keep):
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name == self.INDEX or not os.path.isfile(path):
+                continue
+            size = os.path.getsize(path)
+            entries.append((self.index['used'].get(name, 0), size, path))
+            total += size
+
+        entries.sort()
+        for used, size, path in entries:
+            if total <= self.max_size:
+                break
+            if path in keep:
+                continue
+            print "Evicting %s" % (path,)
+            os.remove(path)
+            self.index['used'].pop(os.path.basename(path), None)
+            total -= size
@@ -1,4 +1,4 @@
-import mpd, os, sys
+import mpd, optparse, os, sys
 import mpdipod, mpdutils
 
 # iPod mount point (make sure it's properly mounted)
@@ -13,29 +13,60 @@ MP3_ROOT = os.path.expanduser('/data/mp3s/done')
 # Covers dir
 COVERS_DIR = os.path.expanduser('~/.covers/')
 
-def sync(ipod, playlists):
-    for mpd_playlist, ipod_playlist in playlists:
-        tracks = []
-        for filename in mpdutils.get_filenames(mpd_playlist,
+# options parser
+parser = optparse.OptionParser(usage = "Usage: %prog [options] <playlist-name>...")
+parser.add_option("-n", "--dry-run", dest="dryRun",
+                  action="store_true", default=False,
+                  help="Only print the changes each playlist would need")
+parser.add_option("-f", "--fill", dest="fill",
+                  action="store_true", default=False,
+                  help="If not everything fits, copy the highest priority tracks (see -p and -s) until the iPod is full")
+parser.add_option("-p", "--priority-playlist", dest="priorityPlaylist",
+                  metavar="PLAYLIST", default=None,
+                  help="MPD playlist (e.g. made by mpdspl.py) whose tracks get copied first with -f")
+parser.add_option("-s", "--sticker-file", dest="stickerFile",
+                  metavar="FILE", default=None,
+                  help="MPD sticker file, whose ratings order the tracks copied with -f")
+mpdutils.add_transcode_options(parser)
+
+def get_priority(options):
+    """ Rank tracks by presence in the priority playlist, then rating. """
+    preferred = set()
+    if options.priorityPlaylist:
+        preferred = set(mpdutils.get_filenames(options.priorityPlaylist,
                                                MPD_CONNECTION,
-                                               MP3_ROOT):
-            track = ipod.track_factory(filename)
-            if track:
-                tracks.append(track)
+                                               MP3_ROOT))
+    ratings = {}
+    if options.stickerFile:
+        ratings = mpdutils.get_ratings(options.stickerFile)
 
-        if not ipod.check_freespace(tracks):
-            raise FreeSpaceException("Not enough free space!")
-        ipod.sync_playlist(ipod_playlist, tracks)
-    return True
+    def priority(filename):
+        return (filename in preferred,
+                ratings.get(os.path.relpath(filename, MP3_ROOT), 0))
+    return priority
+
+def sync(ipod, playlists, dry_run = False, fill = False, transcoder = None,
+         priority = None):
+    planner = mpdipod.SyncPlanner(ipod, priority, transcoder)
+    for mpd_playlist, ipod_playlist in playlists:
+        planner.add_playlist(ipod_playlist,
+                             mpdutils.get_filenames(mpd_playlist,
+                                                    MPD_CONNECTION,
+                                                    MP3_ROOT))
+    return planner.execute(fill, dry_run)
 
 def main():
+    options, args = parser.parse_args(sys.argv[1:])
     playlists = []
-    for pl in sys.argv[1:]:
+    for pl in args:
         playlists.append((pl, pl))
 
-    ipod = mpdipod.iPod(MOUNT_POINT)
-    sync(ipod, playlists)
-    ipod.close()
+    transcoder = mpdutils.get_transcoder(options)
+    ipod = mpdipod.iPod(MOUNT_POINT, COVERS_DIR)
+    sync(ipod, playlists, options.dryRun, options.fill, transcoder,
+         get_priority(options))
+    if not options.dryRun:
+        ipod.close()
 
 if __name__ == '__main__':
      main()